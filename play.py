@@ -2,24 +2,220 @@
 
 import argparse
 import curses
+import io
+import itertools
 import logging
 import os
 import shutil
-import tempfile
+import subprocess
+import threading
+import time
+import wave
+from concurrent.futures import Future, wait
 from pathlib import Path
-from typing import Optional
+from typing import Any, Callable, Optional
 
-os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"
+import platformdirs
 
-import pygame
-import pygame.mixer_music as pgm
-import sox
-import yt_dlp
-
-AUDIO_FORMAT = "flac"
+# saved downloads are converted to FLAC. otherwise, downloads are kept in their original container
+# and the playback audio is uncompressed WAV, to skip pointless encode/decode round trips
+SAVE_FORMAT = "flac"
+# NOTE: SoX supports WAV, MP3, Ogg, and FLAC. anything else is decoded with ffmpeg
+SOX_FORMATS = {".wav", ".mp3", ".ogg", ".flac"}
+SAMPLE_RATE = 44100
+CHANNELS = 2
 SEEK_DISTANCE_SECONDS = 5
 VOLUME_INCREMENT = 10
 PROGRESS_BAR_WIDTH = 60
+REFRESH_INTERVAL_MS = 250
+HELP_STRING = "space: pause, r: restart, left/right: seek, up/down: volume, q/esc: quit"
+HELP_LEN = len(HELP_STRING)
+CACHE_DIR = Path(platformdirs.user_cache_dir("tempo-player"))
+CACHE_SIZE_LIMIT = 5 * 1024**3
+PARTIAL_DOWNLOAD_SUFFIXES = {".part", ".ytdl", ".aria2"}
+PARTIAL_DOWNLOAD_MAX_AGE_SECONDS = 24 * 60 * 60
+
+
+def download_audio(url: str) -> Path:
+    import yt_dlp
+
+    # keep whatever container the audio is served in. converting it would mean a full decode and
+    # FLAC encode of every download, and SoX can't read most of those containers anyway
+    options = {
+        "format": "bestaudio/best",
+        "outtmpl": str(Path(CACHE_DIR, "%(id)s.%(ext)s")),
+        "noplaylist": True,
+        # the cache is evicted by mtime, so don't backdate new downloads to the server's timestamp
+        "updatetime": False,
+        "logger": logging.getLogger(),
+    }
+
+    # aria2c downloads over several connections at once, which is much faster than yt-dlp's
+    # single connection downloader
+    if shutil.which("aria2c") is not None:
+        options["external_downloader"] = {"default": "aria2c"}
+        options["external_downloader_args"] = {
+            "aria2c": ["-x", "16", "-s", "16", "-k", "1M"]
+        }
+
+    with yt_dlp.YoutubeDL(options) as ydl:
+        try:
+            # downloads are cached by video id, so only fetch the metadata to see if we already
+            # have this one
+            info = ydl.extract_info(url, download=False)
+            cached_file = Path(ydl.prepare_filename(info))
+            if cached_file.exists():
+                # mark as recently used
+                cached_file.touch()
+            else:
+                ydl.process_ie_result(info, download=True)
+        except yt_dlp.utils.DownloadError as e:
+            raise SystemExit("ERROR: Failed to download audio (invalid URL?)") from e
+
+    # evict the least recently used downloads once the cache grows too large. leftovers of
+    # interrupted downloads count toward the limit too, and are dropped once they're too old to be
+    # worth resuming
+    cache_size = 0
+    now = time.time()
+    for file in sorted(
+        (file for file in CACHE_DIR.iterdir() if file.is_file()),
+        key=lambda file: file.stat().st_mtime,
+        reverse=True,
+    ):
+        file_stat = file.stat()
+        if (
+            file.suffix in PARTIAL_DOWNLOAD_SUFFIXES
+            and now - file_stat.st_mtime > PARTIAL_DOWNLOAD_MAX_AGE_SECONDS
+        ):
+            file.unlink(missing_ok=True)
+            continue
+        cache_size += file_stat.st_size
+        if cache_size > CACHE_SIZE_LIMIT and file != cached_file:
+            file.unlink(missing_ok=True)
+
+    return cached_file
+
+
+def save_audio(source_file: Path, save: str | Path) -> None:
+    try:
+        subprocess.run(
+            [
+                "ffmpeg",
+                "-nostdin",
+                "-v",
+                "error",
+                "-y",
+                "-i",
+                str(source_file),
+                str(Path(save).with_suffix(f".{SAVE_FORMAT}")),
+            ],
+            # keep ffmpeg off the terminal, it's owned by the curses UI. it also gets its own
+            # session so a ctrl+c meant for the player doesn't cut the saved file short
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            check=True,
+            start_new_session=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        # user probably passed a directory or some other stupid path, oh well, we tried
+        pass
+
+
+def prepare_playback(
+    source_file: Path, tempo: float, start: float, end: Optional[float]
+) -> tuple[Path | io.BytesIO, float]:
+    import mutagen
+    import numpy as np
+    import sox
+
+    # generate the playback audio by adjusting the tempo. use the mixer's format so pygame doesn't
+    # need to convert it again
+    transformer = sox.Transformer()
+    transformer.set_output_format(rate=SAMPLE_RATE, bits=16, channels=CHANNELS)
+    if start != 0.0 or end is not None:
+        transformer.trim(start, end)
+    if tempo != 1.0:
+        transformer.tempo(tempo, audio_type="m")
+
+    if source_file.suffix.lower() not in SOX_FORMATS:
+        # SoX can't read this format (e.g. the webm/m4a audio YouTube serves), so decode it with
+        # ffmpeg straight into memory first
+        try:
+            decoded = subprocess.run(
+                [
+                    "ffmpeg",
+                    "-nostdin",
+                    "-v",
+                    "error",
+                    "-i",
+                    str(source_file),
+                    "-f",
+                    "s16le",
+                    "-ac",
+                    str(CHANNELS),
+                    "-ar",
+                    str(SAMPLE_RATE),
+                    "-",
+                ],
+                stdin=subprocess.DEVNULL,
+                capture_output=True,
+                check=True,
+            ).stdout
+        except subprocess.CalledProcessError as e:
+            raise SystemExit("ERROR: Failed to decode audio") from e
+        samples = np.frombuffer(decoded, dtype=np.int16).reshape(-1, CHANNELS)
+        if len(transformer.effects) > 0:
+            samples = transformer.build_array(
+                input_array=samples, sample_rate_in=SAMPLE_RATE
+            )
+    elif len(transformer.effects) > 0:
+        samples = transformer.build_array(input_filepath=str(source_file))
+    else:
+        # play the file as is. read the duration from the file's header in-process rather than
+        # shelling out to soxi
+        try:
+            audio = mutagen.File(source_file)
+        except mutagen.MutagenError:
+            audio = None
+        if audio is None:
+            return source_file, sox.file_info.duration(source_file)
+        return source_file, audio.info.length
+
+    # keep the playback audio in memory as a WAV instead of encoding it to a file
+    playback_file = io.BytesIO()
+    with wave.open(playback_file, "wb") as wav:
+        wav.setnchannels(CHANNELS)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(samples)
+    playback_file.seek(0)
+    return playback_file, len(samples) / SAMPLE_RATE
+
+
+def run_in_background(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
+    # use a daemon thread so quitting (e.g. ctrl+c during a download) doesn't have to wait for the
+    # work to finish first. an executor would join its workers at exit, so the future is created
+    # and completed by hand here on purpose
+    future = Future()
+
+    def run() -> None:
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def wait_with_status(stdscr: curses.window, future: Future, message: str) -> Any:
+    # keep the UI alive with an animated status message while work happens in the background
+    for n_dots in itertools.cycle(range(4)):
+        stdscr.erase()
+        stdscr.addstr(0, 0, message + "." * n_dots)
+        stdscr.refresh()
+        if wait([future], timeout=REFRESH_INTERVAL_MS / 1000).done:
+            return future.result()
 
 
 def main(
@@ -31,92 +227,88 @@ def main(
     loop: bool = False,
     save: Optional[str | Path] = None,
 ) -> None:
-    curses.start_color()
-    curses.use_default_colors()
     curses.curs_set(0)
-
-    stdscr.nodelay(True)
-
-    with tempfile.TemporaryDirectory() as work_dir:
-        if file_or_url.startswith("http"):
-            # download from youtube
-            stdscr.clear()
-            stdscr.addstr(0, 0, "Downloading song...")
-            stdscr.refresh()
-
-            source_file = Path(work_dir, f"audio.{AUDIO_FORMAT}")
-
-            options = {
-                "format": "bestaudio/best",
-                "outtmpl": str(source_file.with_suffix("")),
-                "postprocessors": [
-                    {
-                        "key": "FFmpegExtractAudio",
-                        "preferredcodec": AUDIO_FORMAT,
-                        "preferredquality": "0",
-                    }
-                ],
-                "logger": logging.getLogger(),
-            }
-
-            with yt_dlp.YoutubeDL(options) as ydl:
-                try:
-                    ydl.download([file_or_url])
-                except yt_dlp.utils.DownloadError as e:
-                    raise SystemExit(
-                        "ERROR: Failed to download audio (invalid URL?)"
-                    ) from e
-
-            # copy the downloaded file if the user wants to keep it
-            if save is not None:
-                try:
-                    shutil.copy(source_file, Path(save).with_suffix(f".{AUDIO_FORMAT}"))
-                except OSError:
-                    # user probably passed a directory or some other stupid path, oh well, we tried
-                    pass
-        else:
-            # play from file
-            source_file = Path(file_or_url)
-            if not source_file.exists():
-                raise SystemExit("ERROR: File not found")
-
-        stdscr.clear()
-        stdscr.addstr(0, 0, "Loading...")
-        stdscr.refresh()
-
-        # generate the playback file by adjusting the tempo
-        # NOTE: SoX supports WAV, MP3, Ogg, and FLAC
-        playback_file = Path(work_dir, f"playback.{AUDIO_FORMAT}")
-        transformer = sox.Transformer()
-        if start != 0.0 or end is not None:
-            transformer.trim(start, end)
-        if tempo != 1.0:
-            transformer.tempo(tempo, audio_type="m")
-        if len(transformer.effects) > 0:
-            transformer.build(source_file, playback_file)
-        else:
-            playback_file = source_file
-        audio_length = sox.file_info.duration(playback_file)
-
-        # load the playback file
-        # NOTE: pygame only supports MP3 and FLAC with functional seeking
-        pygame.mixer.init()
+    # the cursor is hidden, so don't waste writes moving it back after every update
+    stdscr.leaveok(True)
+
+    # block on key presses for at most one refresh interval, the UI doesn't need to update any faster
+    stdscr.timeout(REFRESH_INTERVAL_MS)
+
+    if not file_or_url.startswith("http") and not Path(file_or_url).exists():
+        raise SystemExit("ERROR: File not found")
+
+    # the audio libraries are slow to import, so they're only imported once there's something to
+    # play. this keeps `--help` and bad paths fast
+    os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"
+    import pygame
+    import pygame.mixer_music as pgm
+
+    # initializing the mixer takes a moment, so get it out of the way while the audio is
+    # prepared. use a large buffer, the extra latency doesn't matter for a music player and the
+    # small default buffer can cause underruns (audible pops, glitches in other apps on pipewire)
+    mixer_ready = run_in_background(
+        pygame.mixer.init,
+        frequency=SAMPLE_RATE,
+        size=-16,
+        channels=CHANNELS,
+        buffer=4096,
+    )
+
+    saved = None
+    if file_or_url.startswith("http"):
+        # download from youtube
+        source_file = wait_with_status(
+            stdscr,
+            run_in_background(download_audio, file_or_url),
+            "Downloading song",
+        )
+
+        # save a copy of the downloaded audio if the user wants to keep it. this happens in the
+        # background while the playback audio is prepared
+        if save is not None:
+            saved = run_in_background(save_audio, source_file, save)
+    else:
+        # play from file
+        source_file = Path(file_or_url)
+
+    try:
+        playback_file, audio_length = wait_with_status(
+            stdscr,
+            run_in_background(prepare_playback, source_file, tempo, start, end),
+            "Loading",
+        )
+
+        # load the playback audio
+        # NOTE: pygame only supports WAV, MP3, and FLAC with functional seeking
+        mixer_ready.result()
         pgm.load(playback_file)
 
         # pygame does not really support seeking. all we have to work with is the absolute time
         # since `play` was called, and the ability to call `play` with a start offset. therefore, we
-        # need to do some clever state tracking to emulate seeking
+        # need to do some clever state tracking to emulate seeking. positions are tracked in integer
+        # milliseconds like `get_pos`, so the UI can be updated with integer-only math
+        # NOTE: `play` restarts the music at the new offset by itself, so seeking never needs to stop
+        # playback first. while playing, `set_pos` is used instead to seek with the format's own
+        # seek support
+        audio_length_ms = max(int(audio_length * 1000), 1)
         time_since_play = start_offset = 0
         paused = False
-        pgm.play(start=start_offset)
+        pgm.play(start=start_offset / 1000)
+
+        # the tempo never changes during playback
+        formatted_tempo = f"tempo: {tempo:.2f}x"
+
+        # the terminal size rarely changes, so only recompute the layout on resize
+        resized = True
 
         while True:
             try:
+                # handle key presses. `getch` can block for a while, so read the position after it
+                # returns to act on where playback actually is
+                key = stdscr.getch()
                 if pgm.get_busy():
-                    time_since_play = pgm.get_pos() / 1000
+                    time_since_play = pgm.get_pos()
 
-                # handle key presses
-                key = stdscr.getch()
                 if key != -1:
                     # quit
                     if key == pygame.K_q or key == pygame.K_ESCAPE:
@@ -124,43 +316,51 @@ def main(
 
                     # pause/unpause
                     elif key == pygame.K_SPACE:
+                        # nothing on screen moves while paused, so sleep until the next key press
+                        # instead of waking up every refresh interval
                         if paused:
-                            pgm.play(start=start_offset)
+                            pgm.play(start=start_offset / 1000)
+                            stdscr.timeout(REFRESH_INTERVAL_MS)
                         else:
                             start_offset = min(
-                                start_offset + time_since_play, audio_length
+                                start_offset + time_since_play, audio_length_ms
                             )
                             time_since_play = 0
                             pgm.stop()
+                            stdscr.timeout(-1)
                         paused = not paused
 
                     # restart
                     elif key == pygame.K_r:
                         time_since_play = start_offset = 0
-                        pgm.stop()
                         if not paused:
-                            pgm.play(start=start_offset)
-
-                    # seek backward
-                    elif key == curses.KEY_LEFT:
-                        start_offset = max(
-                            0, start_offset + time_since_play - SEEK_DISTANCE_SECONDS
+                            pgm.play(start=start_offset / 1000)
+
+                    # seek backward/forward
+                    elif key == curses.KEY_LEFT or key == curses.KEY_RIGHT:
+                        seek_distance = SEEK_DISTANCE_SECONDS * 1000
+                        if key == curses.KEY_LEFT:
+                            seek_distance = -seek_distance
+                        position = min(
+                            max(0, start_offset + time_since_play + seek_distance),
+                            audio_length_ms,
                         )
-                        time_since_play = 0
-                        pgm.stop()
-                        if not paused:
-                            pgm.play(start=start_offset)
-
-                    # seek forward
-                    elif key == curses.KEY_RIGHT:
-                        start_offset = min(
-                            start_offset + time_since_play + SEEK_DISTANCE_SECONDS,
-                            audio_length,
-                        )
-                        time_since_play = 0
-                        pgm.stop()
-                        if not paused:
-                            pgm.play(start=start_offset)
+                        if paused:
+                            # playback resumes from the offset on unpause
+                            start_offset = position
+                            time_since_play = 0
+                        else:
+                            try:
+                                # `set_pos` seeks without restarting the decoder, but `get_pos`
+                                # keeps counting from the original `play`
+                                pgm.set_pos(position / 1000)
+                                start_offset = position - time_since_play
+                            except pygame.error:
+                                # the format doesn't support `set_pos` (or the track already
+                                # ended), so restart the music at the new offset instead
+                                start_offset = position
+                                time_since_play = 0
+                                pgm.play(start=start_offset / 1000)
 
                     # volume up
                     elif key == curses.KEY_UP:
@@ -174,37 +374,55 @@ def main(
                             max(0, pgm.get_volume() - VOLUME_INCREMENT / 100)
                         )
 
+                    # terminal resized
+                    elif key == curses.KEY_RESIZE:
+                        resized = True
+
                 # loop
                 if loop and not paused and not pgm.get_busy():
                     time_since_play = start_offset = 0
-                    pgm.play(start=start_offset)
+                    pgm.play(start=start_offset / 1000)
+
+                # redraw everything from scratch on resize. otherwise, only the parts of the screen
+                # that changed since the last frame are written to the terminal
+                if resized:
+                    height, width = stdscr.getmaxyx()
+                    center_y = height // 2
+                    max_width = width - 2
+                    max_bars = max(0, min(max_width - 2, PROGRESS_BAR_WIDTH))
+                    bar_x = (width - max_bars - 2) // 2
+                    help_x = (width - HELP_LEN) // 2
+
+                    # every state of the progress bar is built up front, so drawing it is a lookup
+                    progress_bars = tuple(
+                        "[" + "=" * n + " " * (max_bars - n) + "]"
+                        for n in range(max_bars + 1)
+                    )
+
+                    stdscr.clear()
+                    # skip the progress bar if the terminal is too narrow for it. with no bars,
+                    # it never changes and never gets drawn
+                    if max_bars > 0:
+                        stdscr.addstr(center_y, bar_x, progress_bars[0])
+                    if center_y < height - 2 and HELP_LEN < max_width:
+                        stdscr.addstr(center_y + 2, help_x, HELP_STRING)
+                    prev_n_bars = 0
+                    prev_time_s = prev_volume_100 = None
+                    resized = False
 
                 t = start_offset + time_since_play
-                height, width = stdscr.getmaxyx()
-                center_y = height // 2
-                max_width = width - 2
-                strings_to_draw = []
 
                 # draw progress bar
-                progress = min(t / audio_length, 1)
-                max_bars = min(max_width - 2, PROGRESS_BAR_WIDTH)
-                n_bars = round(progress * max_bars)
-                progress_bar = "[" + "=" * n_bars + " " * (max_bars - n_bars) + "]"
-                strings_to_draw.append(
-                    (center_y, (width - len(progress_bar)) // 2, progress_bar)
-                )
-
-                # draw info
+                n_bars = min(t * max_bars // audio_length_ms, max_bars)
+                if n_bars != prev_n_bars:
+                    lo = 1 + min(n_bars, prev_n_bars)
+                    hi = 1 + max(n_bars, prev_n_bars)
+                    stdscr.addstr(center_y, bar_x + lo, progress_bars[n_bars][lo:hi])
+                    prev_n_bars = n_bars
+
+                # draw info. the displayed values change rarely, so only rebuild it when they do
                 if center_y > 0:
-                    formatted_tempo = f"tempo: {tempo:.2f}x"
-
-                    minutes, seconds = divmod(int(tempo * t), 60)
-                    hours, minutes = divmod(minutes, 60)
-                    formatted_time = (
-                        f"{hours}:{minutes:02d}:{seconds:02d}"
-                        if hours
-                        else f"{minutes}:{seconds:02d}"
-                    )
+                    time_s = int(tempo * t) // 1000
 
                     # pygame's set_volume isn't very accurate. therefore round the displayed value
                     # to the nearest increment, even though it might be +/- 1
@@ -212,43 +430,44 @@ def main(
                         round(pgm.get_volume() * 100 / VOLUME_INCREMENT)
                         * VOLUME_INCREMENT
                     )
-                    formatted_volume = f"volume: {volume_100:3}%"
 
-                    info_string = (
-                        f"{formatted_tempo} - {formatted_volume} - {formatted_time}"
-                    )
-                    if len(info_string) < max_width:
-                        strings_to_draw.append(
-                            (
-                                center_y - 1,
-                                (width - len(info_string)) // 2,
-                                info_string,
-                            )
+                    if time_s != prev_time_s or volume_100 != prev_volume_100:
+                        minutes, seconds = divmod(time_s, 60)
+                        hours, minutes = divmod(minutes, 60)
+                        formatted_time = (
+                            f"{hours}:{minutes:02d}:{seconds:02d}"
+                            if hours
+                            else f"{minutes}:{seconds:02d}"
                         )
+                        formatted_volume = f"volume: {volume_100:3}%"
 
-                # draw help
-                if center_y < height - 2:
-                    help_string = (
-                        "space: pause, r: restart, left/right: seek, up/down: volume, "
-                        "q/esc: quit"
-                    )
-                    if len(help_string) < max_width:
-                        strings_to_draw.append(
-                            (center_y + 2, (width - len(help_string)) // 2, help_string)
+                        info_string = (
+                            f"{formatted_tempo} - {formatted_volume} - {formatted_time}"
                         )
+                        # the length of the info string can change, so pad it to overwrite the old
+                        # one in a single write
+                        if len(info_string) < max_width:
+                            info_line = (
+                                " " * ((width - len(info_string)) // 2) + info_string
+                            )
+                        else:
+                            info_line = ""
+                        stdscr.addstr(center_y - 1, 0, info_line.ljust(max_width))
+                        prev_time_s, prev_volume_100 = time_s, volume_100
 
-                stdscr.clear()
-                for string in strings_to_draw:
-                    stdscr.addstr(*string)
-                stdscr.refresh()
-
-                curses.napms(10)
+                stdscr.noutrefresh()
+                curses.doupdate()
 
             except KeyboardInterrupt:
                 # quit
                 break
 
         pgm.unload()
+    finally:
+        # let the copy finish however playback ends, so the saved file never ends up
+        # truncated
+        if saved is not None:
+            wait_with_status(stdscr, saved, "Saving")
 
 
 # suppress third party library logging